@@ -13,13 +13,13 @@ def run_web_crawler_for_domain(domain: str):
     Returns:
         None
     """
-    web_crawler = crawler.WebCrawler(domain)
-    web_crawler.crawl_site_for_products()
+    with crawler.WebCrawler(domain) as web_crawler:
+        web_crawler.crawl_site_for_products()
 
 def crawl_ecommerce_domains(domains: list):
     threadpool = concurrent.futures.ThreadPoolExecutor()
+    futures = []
     for domain in domains:
-        futures = []
         futures.append(threadpool.submit(run_web_crawler_for_domain, domain))
     for future in concurrent.futures.as_completed(futures):
         future.result()
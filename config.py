@@ -1,4 +1,14 @@
+import os
+
 MAX_PRODUCT_COUNT = 100
+SITEMAP_PREFETCH_DEPTH = max(4, os.cpu_count() or 1)
+FETCH_MAX_WORKERS = 32
+MAX_PENDING_FETCHES = 64
+POOL_CONNECTIONS = 32
+POOL_MAXSIZE = 128
+REQUEST_HEADERS = {"User-Agent": "Mozilla/5.0 (compatible; web_crawler/1.0)"}
+PRODUCT_PROBE_BYTES = 32768
+OUTPUT_BUFFER_SIZE = 1024 * 1024
 DOMAIN_TO_RUN = ["https://www.boat-lifestyle.com", "https://in.puma.com","https://www.sugarcosmetics.com", "https://www.vivo.com",
                  "https://www.ebay.com", "https://www.flipkart.com", "https://www.meesho.com", "https://www.nykaa.com",
                  "https://www.nike.com", "https://www.bewakoof.com"]
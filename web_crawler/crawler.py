@@ -1,27 +1,96 @@
 import requests
-import xml.etree.ElementTree as ET
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import gzip
 import os
-from io import BytesIO
+import re
 import queue
-from bs4 import BeautifulSoup
-from config import MAX_PRODUCT_COUNT
-from web_crawler.exceptions import MaxProductLimitReached
+import threading
+import concurrent.futures
+from urllib.parse import urlsplit, urlunsplit
+try:
+    # isal's SIMD DEFLATE decodes gzip sitemaps several times faster than zlib
+    from isal import igzip as gzip_reader
+except ImportError:
+    gzip_reader = gzip
+from lxml import etree
+from config import (MAX_PRODUCT_COUNT, SITEMAP_PREFETCH_DEPTH, FETCH_MAX_WORKERS, MAX_PENDING_FETCHES,
+                    POOL_CONNECTIONS, POOL_MAXSIZE, REQUEST_HEADERS, PRODUCT_PROBE_BYTES, OUTPUT_BUFFER_SIZE)
+
+
+PRODUCT_SCHEMA_RE = re.compile(rb'"@type"\s*:\s*"product"', re.IGNORECASE)
+SITEMAP_DIRECTIVE_RE = re.compile(rb'^\s*sitemap[ \t]*:[ \t]*(\S+)', re.IGNORECASE | re.MULTILINE)
+STATIC_EXTENSIONS = frozenset(['jpg', 'jpeg', 'png', 'gif', 'css', 'js', 'pdf', 'doc', 'docx', 'xls', 'xlsx', 'webp'])
+SITEMAP_EXTENSIONS = ('.xml', '.gz')
 
 
 class WebCrawler:
 
+    __slots__ = ('domain', 'domain_folder_name', '_seen', 'sitemap_queue', 'already_processed_sitemaps',
+                 '_html_parsers', 'requests_session', 'product_link_contains', '_product_re', 'product_count',
+                 'max_products', '_lock', '_stop', '_fetch_executor', '_fetch_slots', '_out')
+
     def __init__(self, domain: str):
         self.domain = domain
         self.domain_folder_name = domain.split("//")[-1]
-        self.product_links = set()
+        # 64-bit hashes of the product links already written; ints take far less memory than the URLs
+        self._seen = set()
         self.sitemap_queue = queue.Queue()
         self.already_processed_sitemaps = set()
-        self.requests_session = requests.Session()
+        self._html_parsers = threading.local()
+        self.requests_session = self.create_requests_session()
         self.product_link_contains = ['/p/', '/product/', '/dp/', '/item/', '/pd/', '/t/', '/products/']
+        self._product_re = re.compile('|'.join(map(re.escape, self.product_link_contains)))
         self.product_count = 0
         self.max_products = MAX_PRODUCT_COUNT
-        
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._fetch_executor = None
+        self._fetch_slots = threading.BoundedSemaphore(MAX_PENDING_FETCHES)
+        os.makedirs(self.domain_folder_name, exist_ok=True)
+        self._out = open(f'{self.domain_folder_name}/product_links.txt', 'a', buffering=OUTPUT_BUFFER_SIZE)
+
+
+    def __enter__(self):
+        return self
+
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+
+    def close(self):
+        """
+        Flushes any buffered product links and closes the output file.
+
+        Returns:
+            None
+        """
+        with self._lock:
+            self._out.close()
+
+
+    @staticmethod
+    def create_requests_session():
+        """
+        Creates a requests session that keeps a large pool of connections open to the crawled host.
+
+        Every sitemap and page request of a crawl goes to the same host, so reusing pooled
+        connections avoids a TCP and TLS handshake per request. Transient failures are retried
+        with a backoff.
+
+        Returns:
+            requests.Session: The configured session.
+        """
+        session = requests.Session()
+        # raise_on_status=False hands back the last error response once retries run out
+        retries = Retry(total=3, backoff_factor=0.3, status_forcelist=[429, 500, 502, 503, 504],
+                        raise_on_status=False)
+        adapter = HTTPAdapter(pool_connections=POOL_CONNECTIONS, pool_maxsize=POOL_MAXSIZE, max_retries=retries)
+        session.mount('https://', adapter)
+        session.mount('http://', adapter)
+        session.headers.update(REQUEST_HEADERS)
+        return session
 
     def get_sitemap_urls_for_domain(self):
         """
@@ -30,15 +99,8 @@ class WebCrawler:
         Returns:
             list: A list of sitemap URLs found in the domain's robots.txt file.
         """
-        sitemap_urls = []
         res = self.requests_session.get(url = f'{self.domain}/robots.txt')
-        robots_content = res.content.decode()
-        robots_content_lines = [line.strip() for line in robots_content.split("\n")]
-        for line in robots_content_lines:
-            if line.lower().startswith("sitemap:"):
-                sitemap_url = ':'.join(line.split(':')[:0:-1][::-1]).strip()
-                sitemap_urls.append(sitemap_url)
-        return sitemap_urls
+        return [sitemap_url.decode() for sitemap_url in SITEMAP_DIRECTIVE_RE.findall(res.content)]
     
 
     def is_product_url(self, url: str):
@@ -53,26 +115,17 @@ class WebCrawler:
                   self.product_link_contains, indicating it is a product URL. 
                   False otherwise.
         """
-        for pattern in  self.product_link_contains:
-            if pattern in url:
-                return True
-            # else:
-            #     try:
-            #         res = self.requests_session.get(url)
-            #         if res.status_code == 200:
-            #             if '"@type": "product"' in res.text.lower():
-            #                 return True
-            #     except Exception as e:
-            #         print(f"Error checking product URL {url}: {e}")
-        return False
+        return self._product_re.search(url) is not None
 
 
     def fetch_product_url_from_given_url(self, url: str):
         """
         Fetches product URLs from a given URL.
 
-        This method checks if the given URL is a product URL. If it is, the URL is added to the product links set.
-        If the URL is not a product URL, it fetches the page content and extracts all product URLs from the page.
+        This method checks if the given URL is a product URL. If it is, the URL is recorded via add_product_links.
+        Otherwise only the first PRODUCT_PROBE_BYTES of the page are requested and checked for a product
+        JSON-LD type. If that is not conclusive, the full page is fetched, checked again and all product URLs
+        are extracted from it.
 
         Args:
             url (str): The URL to check and fetch product URLs from.
@@ -80,33 +133,190 @@ class WebCrawler:
         Returns:
             None
         """
-        if self.product_count >= self.max_products:
-            raise MaxProductLimitReached("Max products limit reached")
+        if self._stop.is_set():
+            return
         # Check if the given URL is a product URL
         if self.is_product_url(url):
-            self.product_links.add(url)
-            self.product_count +=1
-            print("Product found: ", url)
+            if self.add_product_links([url]):
+                print("Product found: ", url)
             return
-        res = self.requests_session.get(url)
-        if res.status_code == 200:
-            if '"@type": "product"' in res.text.lower():
-                self.product_links.add(url)
-                self.product_count +=1
+        # Probe the start of the page, where the JSON-LD usually sits, before downloading all of it
+        res = self.requests_session.get(url, headers={'Range': f'bytes=0-{PRODUCT_PROBE_BYTES - 1}'},
+                                        stream=True, timeout=10)
+        if res.status_code in (200, 206) and not self.is_html_response(res):
+            res.close()
+            return
+        chunks = res.iter_content(PRODUCT_PROBE_BYTES)
+        head = next(chunks, b'')
+        if res.status_code in (200, 206) and PRODUCT_SCHEMA_RE.search(head):
+            res.close()
+            if self.add_product_links([url]):
                 print("Product found: ", url)
+            return
+        total_size = res.headers.get('Content-Range', '').rpartition('/')[2]
+        if res.status_code == 206 and total_size.isdigit() and int(total_size) <= PRODUCT_PROBE_BYTES:
+            # The whole page fit in the probe, so there is nothing left to download
+            content = head + b''.join(chunks)
+            res.close()
+        elif res.status_code in (206, 416):
+            res.close()
+            res = self.requests_session.get(url, stream=True, timeout=10)
+            if not self.is_html_response(res):
+                res.close()
+                return
+            content = res.content
+        else:
+            # The server ignored the Range header, so the rest of the body is already on its way
+            content = head + b''.join(chunks)
+            res.close()
+        if res.status_code in (200, 206):
+            if PRODUCT_SCHEMA_RE.search(content):
+                if self.add_product_links([url]):
+                    print("Product found: ", url)
                 return
 
         # If not a product URL, extract product URLs from the page
-        soup = BeautifulSoup(res.text, 'html.parser')
-        links = soup.find_all('a', href=True)
-        urls = [link['href'] for link in links]
-        urls = [url for url in urls if self.is_product_url(url)]
-        urls = [url if self.domain in url else f"{self.domain}{url}" for url in urls]
-        self.product_links.update(urls)
-        self.product_count += len(urls)
-        print("Product found: ", urls)
+        # lxml detects the encoding from the raw bytes, so skip the res.text decode
+        document = etree.fromstring(content, self.get_html_parser()) if content else None
+        if document is None:
+            return
+        domain = self.domain
+        product_re = self._product_re
+        urls = []
+        for href in document.xpath('//a/@href'):
+            if not product_re.search(href):
+                continue
+            if not href.startswith(domain):
+                href = domain + href
+            urls.append(href)
+        added = self.add_product_links(urls)
+        if added:
+            print("Product found: ", added)
         return 
-    
+
+
+    def get_html_parser(self):
+        """
+        Returns the calling thread's lxml HTML parser, creating it on first use. A parser
+        instance is reused for every page, but never shared between threads since lxml
+        serialises concurrent use of one parser.
+
+        Returns:
+            lxml.etree.HTMLParser: The parser for the current thread.
+        """
+        parser = getattr(self._html_parsers, 'parser', None)
+        if parser is None:
+            parser = etree.HTMLParser(remove_comments=True, remove_pis=True, no_network=True)
+            self._html_parsers.parser = parser
+        return parser
+
+
+    @staticmethod
+    def is_html_response(res: requests.Response):
+        """
+        Check from the response headers whether a response is an HTML page, before its body is read.
+
+        Args:
+            res (requests.Response): The response to check.
+
+        Returns:
+            bool: True if the Content-Type is HTML or missing, False otherwise.
+        """
+        content_type = res.headers.get('Content-Type')
+        return not content_type or 'html' in content_type.lower()
+
+
+    def add_product_links(self, urls: list):
+        """
+        Writes product URLs that have not been seen before to the buffered output file and
+        signals the crawl to stop once the max product count is reached. URLs beyond the max
+        product count, or arriving after the crawl was stopped, are dropped. Only a hash of
+        each URL is kept for the seen check. Safe to call from multiple worker threads.
+
+        Args:
+            urls (list): The product URLs to add.
+
+        Returns:
+            list: The URLs that were written.
+        """
+        added = []
+        with self._lock:
+            if self._stop.is_set():
+                return added
+            remaining = self.max_products - self.product_count
+            seen = self._seen
+            add = seen.add
+            write = self._out.write
+            for url in urls:
+                if len(added) >= remaining:
+                    break
+                url_hash = hash(url)
+                if url_hash not in seen:
+                    add(url_hash)
+                    write(url + '\n')
+                    added.append(url)
+            self.product_count += len(added)
+            if self.product_count >= self.max_products:
+                self._stop.set()
+        return added
+
+
+    def process_product_link(self, url: str):
+        """
+        Runs fetch_product_url_from_given_url for a URL on a worker thread, printing
+        any error instead of propagating it.
+
+        Args:
+            url (str): The URL to check and fetch product URLs from.
+
+        Returns:
+            None
+        """
+        try:
+            self.fetch_product_url_from_given_url(url)
+        except Exception as e:
+            print(f"Error processing product link {url}: {e}")
+
+
+    def submit_product_link(self, url: str):
+        """
+        Queues a URL for process_product_link on the fetch pool. Blocks while
+        MAX_PENDING_FETCHES fetches are already queued or running, so a large sitemap
+        cannot flood the pool with pending tasks.
+
+        Args:
+            url (str): The URL to check and fetch product URLs from.
+
+        Returns:
+            None
+        """
+        self._fetch_slots.acquire()
+        future = self._fetch_executor.submit(self.process_product_link, url)
+        future.add_done_callback(lambda _: self._fetch_slots.release())
+
+
+    def _enqueue_sitemap(self, url: str):
+        """
+        Adds a sitemap URL to the sitemap queue unless it has already been queued.
+        The already_processed_sitemaps key lowercases the scheme and host and strips a trailing
+        '/', so the same sitemap linked from several sitemap indexes is only downloaded once.
+        The URL itself is queued unchanged.
+
+        Args:
+            url (str): The sitemap URL to queue.
+
+        Returns:
+            None
+        """
+        parts = urlsplit(url)
+        key = urlunsplit((parts.scheme.lower(), parts.netloc.lower(), parts.path.rstrip('/'), parts.query, parts.fragment))
+        with self._lock:
+            if key in self.already_processed_sitemaps:
+                return
+            self.already_processed_sitemaps.add(key)
+        self.sitemap_queue.put(url)
+
+
     def is_static_url(self, url: str):
         """
         Check if a given URL is a static URL.
@@ -115,101 +325,129 @@ class WebCrawler:
             url (str): The URL to check.
 
         Returns:
-            bool: True if the URL ends with any of the patterns specified in 
-                  self.static_link_ends, indicating it is a static URL. 
-                  False otherwise.
+            bool: True if the URL path ends with a static file extension (images, css, js,
+                  documents), ignoring any query string or fragment. False otherwise.
         """
-        static_link_ends = ['.jpg', '.jpeg', '.png', '.gif', '.css', '.js', '.pdf', '.doc', '.docx', '.xls', '.xlsx', '.webp']
-        for pattern in static_link_ends:
-            if pattern in url:
-                return True
-        return False
+        return url.partition('?')[0].partition('#')[0].rpartition('.')[2].lower() in STATIC_EXTENSIONS
 
-    def get_urls_from_sitemap_content(self, sitemap_url: str):
+    def read_sitemap_locs(self, sitemap_url: str):
         """
-        Retrieves URLs from the content of a sitemap.
-        This method fetches the sitemap content from the given URL, parses it, and extracts URLs.
-        If the sitemap URL has already been processed, it will be skipped. If the sitemap content
-        is compressed (ends with .gz), it will be decompressed before parsing.
+        Downloads a sitemap and returns the URLs listed in its <loc> elements.
+        The sitemap is parsed as it streams in, and parsed entries are freed so memory stays
+        flat on large sitemaps. If the sitemap content is compressed (ends with .gz), it is
+        decompressed while streaming. Relative URLs are prefixed with the domain.
         Args:
-            sitemap_url (str): The URL of the sitemap to process.
+            sitemap_url (str): The URL of the sitemap to read.
+        Returns:
+            list: The URLs listed in the sitemap.
         Raises:
             requests.RequestException: If there is an issue with the HTTP request.
             gzip.BadGzipFile: If there is an issue with decompressing the gzip file.
-            Exception: For any other exceptions that may occur during processing.
+        """
+        urls = []
+        with self.requests_session.get(sitemap_url, timeout=10, stream=True) as sitemap_resp:
+            sitemap_resp.raise_for_status()
+            sitemap_stream = sitemap_resp.raw
+            sitemap_stream.decode_content = True
+            if sitemap_url.endswith('.gz'):
+                sitemap_stream = gzip_reader.open(sitemap_stream, 'rb')
+            domain = self.domain
+            stopped = self._stop.is_set
+            append = urls.append
+            for event, elem in etree.iterparse(sitemap_stream, events=('end',), tag='{*}loc'):
+                if stopped():
+                    break
+                url = elem.text.strip() if elem.text else None
+                if url:
+                    append(url if url.startswith(domain) else domain + url)
+                # Drop the finished <url>/<sitemap> entries that precede this one
+                elem.clear()
+                entry = elem.getparent()
+                while entry is not None and entry.getparent() is not None and entry.getprevious() is not None:
+                    del entry.getparent()[0]
+        return urls
+
+
+    def get_urls_from_sitemap_content(self, sitemap_url: str, sitemap_locs: concurrent.futures.Future):
+        """
+        Processes the URLs of a sitemap that has been read by read_sitemap_locs.
+        The sitemap is downloaded and parsed ahead of time on the prefetch pool, so this only
+        waits for it if the prefetch has not finished yet.
+        Args:
+            sitemap_url (str): The URL of the sitemap to process.
+            sitemap_locs (concurrent.futures.Future): The pending result of read_sitemap_locs.
         Notes:
             - URLs ending with .xml or .gz are added to the sitemap queue for further processing.
             - Other URLs are processed as product links.
             - Errors encountered during processing are printed to the console.
         """
-        if sitemap_url in self.already_processed_sitemaps:
-            return
         try:
-            sitemap_resp = self.requests_session.get(sitemap_url, timeout=10, stream=True)
-            sitemap_resp.raise_for_status()
-            sitemap_content = sitemap_resp.content
-            if sitemap_url.endswith('.gz'):
-                sitemap_content = gzip.decompress(sitemap_content)
-            for event, elem in ET.iterparse(BytesIO(sitemap_content), events=('end',)):
-                if 'loc' in elem.tag.split('}')[-1]:
-                    if elem.text and elem.text.strip():
-                        url = elem.text.strip()
-                        if self.domain not in url:
-                            url = f"{self.domain}{url}"
-                        if url.endswith('.xml') or url.endswith('.gz'):
-                            self.sitemap_queue.put(url)
-                        elif self.is_static_url(url):
-                            continue
-                        else:
-                            try:
-                                if self.domain not in url:
-                                    url = f"{self.domain}{url}"
-                                self.fetch_product_url_from_given_url(url)
-                            except MaxProductLimitReached as e:
-                                print(f"Max products limit of {self.max_products} reached: {e}")
-                                return
-                            except requests.RequestException as e:
-                                print(f"Error processing product link {url}: {e}")
-                elem.clear()
+            urls = sitemap_locs.result()
         except (requests.RequestException, gzip.BadGzipFile, Exception) as e:
             print(f"Error processing sitemap url {sitemap_url}: {e}")
-        self.already_processed_sitemaps.add(sitemap_url)
+            return
+        stopped = self._stop.is_set
+        enqueue_sitemap = self._enqueue_sitemap
+        submit_product_link = self.submit_product_link
+        is_static_url = self.is_static_url
+        for url in urls:
+            if stopped():
+                break
+            if url.endswith(SITEMAP_EXTENSIONS):
+                enqueue_sitemap(url)
+            elif not is_static_url(url):
+                submit_product_link(url)
         return
 
 
     def save_products_to_file(self):
         """
-        Saves the product links to a file.
-        The product links are saved to a file named 'product_links.txt' in the domain folder.
+        Flushes the buffered product links to the file.
+        Product links are written to 'product_links.txt' in the domain folder as they are found.
         Returns:
-            None
+            bool: False once the max product count has been reached, True otherwise.
         """
-        if not self.product_links:
-            return
-        if not os.path.exists(self.domain_folder_name):
-            os.makedirs(self.domain_folder_name)
-        with open(f'{self.domain_folder_name}/product_links.txt', 'a') as f:
-            f.write('\n'.join(self.product_links))
-        if self.product_count >= self.max_products:
-            raise MaxProductLimitReached("Max products reached")
-        self.product_links = set()
-        return
+        with self._lock:
+            self._out.flush()
+        return self.product_count < self.max_products
     
 
     def crawl_site_for_products(self):
         """
         Extracts product links from a given sitemap URL.
+        Up to SITEMAP_PREFETCH_DEPTH queued sitemaps are downloaded and parsed in parallel on a
+        prefetch pool. lxml and the gzip decoders release the GIL, so parsing scales across cores.
+        Each sitemap's URLs are handed, in the order the sitemaps finish, to a separate pool of
+        FETCH_MAX_WORKERS threads, so sitemap downloads overlap with page fetching.
+        Product links are flushed to the file after every sitemap.
         Returns:
             list: A list of product links found in the sitemap.
         """
         site_map_urls = self.get_sitemap_urls_for_domain()
         for site_map_url in site_map_urls:
-            self.sitemap_queue.put(site_map_url)
-        while not self.sitemap_queue.empty():
-            self.get_urls_from_sitemap_content(self.sitemap_queue.get())
+            self._enqueue_sitemap(site_map_url)
+        with concurrent.futures.ThreadPoolExecutor(max_workers=SITEMAP_PREFETCH_DEPTH) as sitemap_executor, \
+                concurrent.futures.ThreadPoolExecutor(max_workers=FETCH_MAX_WORKERS) as fetch_executor:
+            self._fetch_executor = fetch_executor
+            prefetched = {}
             try:
-                self.save_products_to_file()
-            except MaxProductLimitReached as e:
-                print(f"Max products limit of {self.max_products} reached: {e}")
-                return
+                while not self._stop.is_set():
+                    while len(prefetched) < SITEMAP_PREFETCH_DEPTH and not self.sitemap_queue.empty():
+                        sitemap_url = self.sitemap_queue.get()
+                        prefetched[sitemap_executor.submit(self.read_sitemap_locs, sitemap_url)] = sitemap_url
+                    if not prefetched:
+                        break
+                    # Dispatch whichever sitemaps are parsed first so a large one does not hold up the rest
+                    done, _ = concurrent.futures.wait(prefetched, return_when=concurrent.futures.FIRST_COMPLETED)
+                    for sitemap_locs in done:
+                        self.get_urls_from_sitemap_content(prefetched.pop(sitemap_locs), sitemap_locs)
+                    self.save_products_to_file()
+                if not self._stop.is_set():
+                    # Let the fetches of the last sitemap finish before the final flush
+                    fetch_executor.shutdown(wait=True)
+                if not self.save_products_to_file():
+                    print(f"Max products limit of {self.max_products} reached")
+            finally:
+                sitemap_executor.shutdown(wait=False, cancel_futures=True)
+                fetch_executor.shutdown(wait=False, cancel_futures=True)
         return
@@ -1,2 +0,0 @@
-class MaxProductLimitReached(Exception):
-    pass
\ No newline at end of file